@@ -3,6 +3,7 @@ import sys
 sys.path.append('.')
 from os.path import join
 from common.utils import read_json, dump_json, load_bin, dump_to_bin
+from common.interp_shard import has_interp_shard, iter_interp_records
 from collections import OrderedDict
 from types import SimpleNamespace
 from transformers import AutoTokenizer
@@ -74,11 +75,18 @@ def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
     return max(scores_for_ground_truths)
 
 def load_interp_info(file_dict, qas_id):
-    return torch.load(file_dict[qas_id])
+    interp = file_dict[qas_id]
+    # records from a shard are already loaded
+    if isinstance(interp, dict):
+        return interp
+    return torch.load(interp)
 
 def build_file_dict(args):
     # prefix = 'squad_sample-addsent_roberta-base'
     prefix = '{}_{}_roberta-base'.format(args.dataset, args.split)
+    interp_dir = join('interpretations', args.method, prefix)
+    if has_interp_shard(interp_dir):
+        return {record['feature'].qas_id: record for record in iter_interp_records(interp_dir)}
     fnames = os.listdir(join('interpretations', args.method, prefix))
     qa_ids = [x.split('-',1)[1].split('.')[0] for x in fnames]
     fullnames = [join('interpretations', args.method, prefix, x) for x in fnames]
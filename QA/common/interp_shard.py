@@ -0,0 +1,113 @@
+import os
+import json
+import pickle
+from os.path import join
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+ATTRIBUTION_FILE = 'attributions.npy'
+RECORD_FILE = 'records.pkl'
+SUMMARY_FILE = 'records.jsonl'
+
+class InterpShardWriter:
+    # attributions go to one preallocated memory mapped array, one row per example,
+    # the rest of the info is appended to a single pickle stream
+    def __init__(self, interp_dir, num_rows, max_len, dtype=np.float32, resume=False):
+        attribution_file = join(interp_dir, ATTRIBUTION_FILE)
+        # summaries of examples already dumped, by row
+        self.finished = {}
+        if resume and has_interp_shard(interp_dir):
+            self.attributions = np.load(attribution_file, mmap_mode='r+')
+            assert self.attributions.shape == (num_rows, max_len) and self.attributions.dtype == dtype
+            self._drop_incomplete_records(interp_dir)
+            self.record_file = open(join(interp_dir, RECORD_FILE), 'ab')
+            self.summary_file = open(join(interp_dir, SUMMARY_FILE), 'a', encoding='utf-8')
+        else:
+            self.attributions = np.lib.format.open_memmap(attribution_file,
+                mode='w+', dtype=dtype, shape=(num_rows, max_len))
+            self.record_file = open(join(interp_dir, RECORD_FILE), 'wb')
+            # plain json fields, enough for visualization without unpickling
+            self.summary_file = open(join(interp_dir, SUMMARY_FILE), 'w', encoding='utf-8')
+
+    def _drop_incomplete_records(self, interp_dir):
+        # an interrupted run may leave a truncated last record, keep examples fully written to both files
+        with open(join(interp_dir, RECORD_FILE), 'rb') as f:
+            records = list(_iter_pickle_stream(f))
+        with open(join(interp_dir, SUMMARY_FILE), encoding='utf-8') as f:
+            summaries = [json.loads(line) for line in f if line.endswith('\n')]
+        record_rows = set(r['row'] for r in records)
+        self.finished = {s['row']: s for s in summaries if s['row'] in record_rows}
+
+        with open(join(interp_dir, RECORD_FILE), 'wb') as f:
+            for record in records:
+                if record['row'] in self.finished:
+                    pickle.dump(record, f)
+        with open(join(interp_dir, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+            for summary in self.finished.values():
+                f.write(json.dumps(summary) + '\n')
+
+    def write(self, row, record, attribution, summary=None):
+        if summary is not None:
+            # encode first, an unserializable summary fails before anything is written
+            summary_line = json.dumps(dict(summary, row=row, actual_len=attribution.size), default=_json_default) + '\n'
+        self.attributions[row, :attribution.size] = attribution
+        # the attribution row reaches disk before its record, resume never trusts an unwritten row
+        self.attributions.flush()
+        record = dict(record, row=row, actual_len=attribution.size)
+        pickle.dump(record, self.record_file)
+        self.record_file.flush()
+        if summary is not None:
+            self.summary_file.write(summary_line)
+            self.summary_file.flush()
+
+    def close(self):
+        self.attributions.flush()
+        self.record_file.close()
+        self.summary_file.close()
+
+def _json_default(x):
+    # numpy scalars from the predictions, anything else is a bug in the summary
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError('summary field of type {} is not JSON serializable'.format(type(x).__name__))
+
+def _iter_pickle_stream(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return
+
+def has_interp_shard(interp_dir):
+    return os.path.exists(join(interp_dir, RECORD_FILE))
+
+def iter_interp_records(interp_dir):
+    # yields the same dicts as the per example bin files
+    attributions = np.load(join(interp_dir, ATTRIBUTION_FILE), mmap_mode='r')
+    with open(join(interp_dir, RECORD_FILE), 'rb') as f:
+        for record in _iter_pickle_stream(f):
+            # upcast, the shard may be stored in half precision
+            record['attribution'] = torch.from_numpy(np.array(attributions[record['row'], :record['actual_len']], dtype=np.float32))
+            yield record
+
+def count_interp_summaries(interp_dir):
+    with open(join(interp_dir, SUMMARY_FILE), encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+def iter_interp_summaries(interp_dir):
+    # lightweight records for visualization, no pickled objects involved
+    attributions = np.load(join(interp_dir, ATTRIBUTION_FILE), mmap_mode='r')
+    with open(join(interp_dir, SUMMARY_FILE), encoding='utf-8') as f:
+        for line in f:
+            summary = json.loads(line)
+            yield {
+                'feature': SimpleNamespace(example_index=summary['example_index'], qas_id=summary['qas_id']),
+                'example': SimpleNamespace(answer_text=summary['answer_text'], answers=summary['answers']),
+                'prediction': summary['prediction'],
+                'prelim_result': summary['prelim_result'],
+                'words': summary['words'],
+                'word_attribution': np.array(summary['word_attribution'], dtype=np.float32),
+                'attribution': torch.from_numpy(np.array(attributions[summary['row'], :summary['actual_len']], dtype=np.float32)),
+            }
@@ -531,7 +531,7 @@ class ProbeRobertaForQuestionAnswering(RobertaPreTrainedModel):
 
         return sum_logits    
 
-    # batch size has to be 1
+    # batch size has to be 1 when return_kl
     def probe_forward(
         self,
         input_ids=None,
@@ -564,7 +564,7 @@ class ProbeRobertaForQuestionAnswering(RobertaPreTrainedModel):
         batch_start_logits, batch_end_logits = self.forward(input_ids=input_ids, input_attentions=input_attentions, link_mask=link_mask, **kwargs)
         batch_probs = self.probs_of_span(batch_start_logits, batch_end_logits, start_indexes, end_indexes)
         if not return_kl:
-            return batch_probs.item()
+            return batch_probs.view(-1)
 
         kl_loss = F.kl_div(
             F.log_softmax(batch_start_logits, dim=1),
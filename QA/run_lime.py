@@ -73,7 +73,7 @@ def _mkdir_f(prefix):
 def predict_with_mask(active_mask, tokenizer,  model, base_inputs, full_input_ids):
     input_ids = tokenizer.mask_token_id * torch.ones_like(full_input_ids)
     input_ids[0, active_mask == 1]  = full_input_ids[0, active_mask == 1]
-    prob = model.probe_forward(**base_inputs, input_ids=input_ids)
+    prob = model.probe_forward(**base_inputs, input_ids=input_ids).item()
     return prob
 
 def run_lime(args, tokenizer, model, inputs, feature):    
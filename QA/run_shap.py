@@ -23,13 +23,19 @@ import os
 import shutil
 import random
 import timeit
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm, trange
 from common.config import register_args, load_config_and_tokenizer
+from common.interp_shard import InterpShardWriter, has_interp_shard, count_interp_summaries, iter_interp_summaries
 from functools import partial
 
 from transformers import (
@@ -41,18 +47,17 @@ from transformers import (
     AutoTokenizer,
     get_linear_schedule_with_warmup,
 )
-from transformers.modeling_roberta import create_position_ids_from_input_ids
 
 from data.custom_squad_feature import custom_squad_convert_examples_to_features, SquadResult, SquadProcessor
 
 from data.qa_metrics import (compute_predictions_logits,hotpot_evaluate,)
 
-from run_qa import load_and_cache_examples, set_seed, to_list, merge_predictions, remove_padding
+from run_qa import load_and_cache_examples, set_seed, to_list, merge_predictions
 from probe.probe_models import ProbeRobertaForQuestionAnswering
 from probe.probe_utils import stats_of_layer_attribution, get_link_mask_by_thresholds, get_link_mask_by_token_thresholds
 from int_grad.ig_qa_utils import compute_predictions_index_and_logits
-from vis_tools.vis_utils import visualize_pruned_layer_attributions, merge_tokens_into_words
-from vis_tools.vis_utils import visualize_token_attributions, merge_tokens_into_words
+from vis_tools.vis_utils import visualize_pruned_layer_attributions, visualize_token_attributions, merge_tokens_into_words
+from vis_tools.vis_token import merge_token_attribution_by_segments
 from itertools import combinations
 
 logger = logging.getLogger(__name__)
@@ -62,7 +67,11 @@ MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
 import itertools
 from functools import reduce, partial
-from shap.local_method_utils import run_shap_attribution
+from shap.local_method_utils import run_shap_attribution, run_exact_shap_attribution
+
+
+# inference_mode needs torch>=1.9, no_grad on older releases
+_inference_mode = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad
 
 
 def _mkdir_f(prefix):
@@ -70,34 +79,155 @@ def _mkdir_f(prefix):
         shutil.rmtree(prefix)
     os.makedirs(prefix)
 
-def predict_with_mask(active_mask, tokenizer,  model, base_inputs, full_input_ids):
-    input_ids = tokenizer.mask_token_id * torch.ones_like(full_input_ids)
-    input_ids[0, active_mask == 1]  = full_input_ids[0, active_mask == 1]
-    prob = model.probe_forward(**base_inputs, input_ids=input_ids)
-    return prob
+def trim_padding_collate(batch):
+    # trim to the actual length in the loader workers, only real tokens get copied to the device
+    input_ids, attention_mask, token_type_ids, feature_indices = default_collate(batch)[:4]
+    actual_len = int(attention_mask.sum(dim=1).max())
+    return input_ids[:, :actual_len], attention_mask[:, :actual_len], token_type_ids[:, :actual_len], feature_indices
+
+class CUDAPrefetcher:
+    # copies the next batch to the device on a side stream while the current one is interpreted
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def _preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.batch = None
+            return
+        if self.stream is None:
+            self.batch = batch
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+    def next(self):
+        batch = self.batch
+        if batch is not None and self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(current_stream)
+        self._preload()
+        return batch
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self._preload()
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+    def __len__(self):
+        return len(self.loader)
+
+def allocate_mask_buffers(batch_size, full_input_ids, mask_token_id):
+    # reused by every predict_with_mask call of one example
+    seq_len = full_input_ids.size(1)
+    return {
+        'mask_id': torch.tensor(mask_token_id, dtype=torch.long, device=full_input_ids.device),
+        'host_inactive': torch.empty((batch_size, seq_len), dtype=torch.bool, pin_memory=full_input_ids.is_cuda),
+        'inactive': torch.empty((batch_size, seq_len), dtype=torch.bool, device=full_input_ids.device),
+        'input_ids': torch.empty((batch_size, seq_len), dtype=torch.long, device=full_input_ids.device),
+    }
+
+@_inference_mode()
+def predict_with_mask(active_masks, model, base_inputs, full_input_ids, buffers):
+    # active_masks: N * L, one forward for all the coalitions
+    # explicit batching over the stacked masks, which is what vmapping probe_forward would give
+    num_masks = active_masks.shape[0]
+    host_inactive = buffers['host_inactive'][:num_masks]
+    np.equal(active_masks, 0, out=host_inactive.numpy())
+    inactive = buffers['inactive'][:num_masks]
+    inactive.copy_(host_inactive, non_blocking=True)
+    # fill the preallocated input ids in place, torch.where has no out= on torch 1.6
+    input_ids = buffers['input_ids'][:num_masks]
+    input_ids.copy_(full_input_ids.expand_as(input_ids))
+    input_ids.masked_fill_(inactive, buffers['mask_id'])
+    # expand along batch dim, no copy
+    batched_inputs = {k: v.expand(num_masks, *v.size()[1:]) if torch.is_tensor(v) else v for k, v in base_inputs.items()}
+    probs = model.probe_forward(**batched_inputs, input_ids=input_ids)
+    # back to fp32 before aggregation when running under autocast
+    return probs.float().cpu().numpy()
+
+def memoize_score_fn(score_fn, doc_size, cache_size):
+    # the all-ones and all-zeros coalitions never change within one example, pin them
+    endpoints = {}
+    # small lru cache for duplicate coalitions within one sampling run
+    cache = OrderedDict()
+
+    def cached_score_fn(active_masks):
+        labels = np.empty(active_masks.shape[0])
+        # one bit per token as the key
+        keys = [row.tobytes() for row in np.packbits(active_masks, axis=1)]
+        sizes = active_masks.sum(axis=1)
+        # unseen coalition -> rows asking for it, duplicates in the same batch run once
+        missed = OrderedDict()
+        for i, (key, size) in enumerate(zip(keys, sizes)):
+            if size in endpoints:
+                labels[i] = endpoints[size]
+            elif key in cache:
+                cache.move_to_end(key)
+                labels[i] = cache[key]
+            else:
+                missed.setdefault(key, []).append(i)
+        if not missed:
+            return labels
+
+        missed_rows = [rows[0] for rows in missed.values()]
+        missed_labels = score_fn(active_masks[missed_rows])
+        for (key, rows), label in zip(missed.items(), missed_labels):
+            labels[rows] = label
+            size = sizes[rows[0]]
+            if size == 0 or size == doc_size:
+                endpoints[size] = label
+            else:
+                cache[key] = label
+                if len(cache) > cache_size:
+                    cache.popitem(last=False)
+        return labels
+    return cached_score_fn
 
 def run_shap(args, tokenizer, model, inputs, feature):    
     tokens = feature.tokens
     inputs['return_kl'] = False
 
     full_input_ids = inputs.pop('input_ids')
-    full_positioin_ids = create_position_ids_from_input_ids(full_input_ids, tokenizer.pad_token_id).to(full_input_ids.device)
+    # same as create_position_ids_from_input_ids, computed where full_input_ids lives
+    non_pad_mask = full_input_ids.ne(tokenizer.pad_token_id).long()
+    full_positioin_ids = non_pad_mask.cumsum(dim=1) * non_pad_mask + tokenizer.pad_token_id
 
     # fix position id
     inputs['position_ids'] = full_positioin_ids
     # fix cls ? maybe    
-    score_fn = partial(predict_with_mask, tokenizer=tokenizer, model=model, base_inputs=inputs, full_input_ids=full_input_ids)
-    np_attribution = run_shap_attribution(args, len(tokens), score_fn).reshape((1,-1))
+    buffers = allocate_mask_buffers(args.shap_batch_size, full_input_ids, tokenizer.mask_token_id)
+    score_fn = partial(predict_with_mask, model=model, base_inputs=inputs, full_input_ids=full_input_ids, buffers=buffers)
+    score_fn = memoize_score_fn(score_fn, len(tokens), args.shap_cache_size)
+    # few enough tokens to enumerate every coalition, same estimator as the sampled path
+    if len(tokens) <= args.exact_shap_threshold:
+        np_attribution = run_exact_shap_attribution(args, len(tokens), score_fn).reshape((1,-1))
+    else:
+        np_attribution = run_shap_attribution(args, len(tokens), score_fn).reshape((1,-1))
     return torch.from_numpy(np_attribution)
 
 
+def _bf16_autocast(args):
+    # torch.autocast needs torch>=1.10, only entered with --bf16
+    if not args.bf16:
+        return nullcontext()
+    return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16)
+
 def predict_and_run_shap(args, batch, model, tokenizer, batch_features, batch_examples):
     model.eval()
     batch = tuple(t.to(args.device) for t in batch)
     # only allow batch size 1
     assert batch[0].size(0) == 1    
     # run predictions
-    with torch.no_grad():
+    with _inference_mode(), _bf16_autocast(args):
         inputs = {
             "input_ids": batch[0],
             "attention_mask": batch[1],
@@ -108,17 +238,15 @@ def predict_and_run_shap(args, batch, model, tokenizer, batch_features, batch_ex
             del inputs["token_type_ids"]
         feature_indices = batch[3]
         outputs = model.restricted_forward(**inputs)
+        # logits back to fp32 for computing predictions
+        outputs = tuple(x.float() for x in outputs)
 
     batch_start_logits, batch_end_logits = outputs
-    batch_results = []
-    for i, feature_index in enumerate(feature_indices):
-        eval_feature = batch_features[i]
-        unique_id = int(eval_feature.unique_id)
-
-        output = [to_list(output[i]) for output in outputs]
-        start_logits, end_logits = output
-        result = SquadResult(unique_id, start_logits, end_logits)
-        batch_results.append(result)
+    # one device to host transfer for the whole batch
+    start_np = batch_start_logits.cpu().numpy()
+    end_np = batch_end_logits.cpu().numpy()
+    batch_results = [SquadResult(int(batch_features[i].unique_id), start_np[i].tolist(), end_np[i].tolist())
+        for i in range(len(feature_indices))]
     
     batch_prelim_results, batch_predictions = compute_predictions_index_and_logits(
         batch_examples,
@@ -132,8 +260,9 @@ def predict_and_run_shap(args, batch, model, tokenizer, batch_features, batch_ex
     )
     
     # run attributions
-    batch_start_indexes = torch.LongTensor([x.start_index for x in batch_prelim_results]).to(args.device)
-    batch_end_indexes = torch.LongTensor([x.end_index for x in batch_prelim_results]).to(args.device)
+    # built on the device directly, start and end indexes share one transfer
+    batch_span_indexes = torch.tensor([[x.start_index, x.end_index] for x in batch_prelim_results], dtype=torch.long, device=args.device)
+    batch_start_indexes, batch_end_indexes = batch_span_indexes.unbind(1)
     
     # for data parallel 
     inputs = {
@@ -148,7 +277,7 @@ def predict_and_run_shap(args, batch, model, tokenizer, batch_features, batch_ex
     if args.model_type in ["roberta", "distilbert", "camembert", "bart"]:
         del inputs["token_type_ids"]
     
-    with torch.no_grad():
+    with _inference_mode(), _bf16_autocast(args):
         importances = run_shap(args, tokenizer, model, inputs, batch_features[0])
 
     return batch_predictions, batch_prelim_results, importances
@@ -159,6 +288,9 @@ def shap_interp(args, model, tokenizer, prefix=""):
 
     # fix the model
     model.requires_grad_(False)
+    if args.compile:
+        # the sequence length differs for every example, trace with dynamic shapes instead of recompiling per length
+        model.probe_forward = torch.compile(model.probe_forward, dynamic=True)
 
     dataset, examples, features = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
     
@@ -170,7 +302,10 @@ def shap_interp(args, model, tokenizer, prefix=""):
 
     args.eval_batch_size = 1    
     eval_sampler = SequentialSampler(dataset)
-    eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=trim_padding_collate,
+        num_workers=args.num_workers, pin_memory=args.device.type == 'cuda')
+    # overlap host to device copy of the next example with interpreting the current one
+    eval_prefetcher = CUDAPrefetcher(eval_dataloader, args.device)
 
     # Eval!
     logger.info("***** Running evaluation {} *****".format(prefix))
@@ -178,28 +313,55 @@ def shap_interp(args, model, tokenizer, prefix=""):
     logger.info("  Batch size = %d", args.eval_batch_size)
 
     all_predictions = []
+    # shap values of span probabilities are well within fp16 range
+    shard_writer = InterpShardWriter(args.interp_dir, len(dataset), args.max_seq_length, dtype=np.float16, resume=args.resume)
+    if shard_writer.finished:
+        logger.info("  Resuming, %d examples already interpreted", len(shard_writer.finished))
+    dump_futures = []
+    # running max, checks the float16 cast of the shard is safe
+    max_abs_attribution = 0.0
     start_time = timeit.default_timer()
 
-    for idx, batch in tqdm(enumerate(eval_dataloader), desc="Interpreting", total=min(len(dataset), args.first_n_samples)):
-        if idx == args.first_n_samples:
-            break
-
-        feature_indices = to_list(batch[3])
-        batch_features = [features[i] for i in feature_indices]
-        batch_examples = [examples[i] for i in feature_indices]
-        # batch prem, batch predictions
-        batch = remove_padding(batch, batch_features[0])
-        batch_predictions, batch_prelim_results, batch_importances = predict_and_run_shap(
-            args,
-            batch,
-            model,
-            tokenizer,
-            batch_features,
-            batch_examples
-        )
-        dump_shap_info(args, batch_examples, batch_features, tokenizer, batch_predictions, batch_prelim_results, batch_importances)
-        # lots of info, dump to files immediately        
-        all_predictions.append(batch_predictions)
+    try:
+        # dumping runs off the critical path, the next example starts right away
+        # single worker, records are appended to one file in order
+        with ThreadPoolExecutor(max_workers=1) as io_pool:
+            for idx, batch in tqdm(enumerate(eval_prefetcher), desc="Interpreting", total=min(len(dataset), args.first_n_samples)):
+                if idx == args.first_n_samples:
+                    break
+
+                feature_indices = to_list(batch[3])
+                batch_features = [features[i] for i in feature_indices]
+                batch_examples = [examples[i] for i in feature_indices]
+                # dumped by a previous run, reuse its prediction
+                finished = shard_writer.finished.get(batch_features[0].example_index)
+                if finished is not None:
+                    all_predictions.append({finished['qas_id']: finished['prediction']})
+                    continue
+                # already trimmed to len(feature.tokens) by the collate fn
+                # batch prem, batch predictions
+                batch_predictions, batch_prelim_results, batch_importances = predict_and_run_shap(
+                    args,
+                    batch,
+                    model,
+                    tokenizer,
+                    batch_features,
+                    batch_examples
+                )
+                # a failed dump stops the run now, not after every example has been interpreted
+                dump_futures = _pending_dumps(dump_futures)
+                dump_futures.extend(dump_shap_info(args, batch_examples, batch_features, tokenizer, batch_predictions, batch_prelim_results, batch_importances, shard_writer, io_pool))
+                # lots of info, dump to files immediately        
+                all_predictions.append(batch_predictions)
+                max_abs_attribution = max(max_abs_attribution, batch_importances.abs().max().item())
+
+            # surface any remaining dumping error
+            for future in dump_futures:
+                future.result()
+    finally:
+        # pending dumps are already drained when the pool exits
+        shard_writer.close()
+    logger.info("  Max abs attribution = %f, stored as float16", max_abs_attribution)
 
     evalTime = timeit.default_timer() - start_time
     logger.info("  Evaluation done in total %f secs (%f sec per example)", evalTime, evalTime / len(dataset))
@@ -216,12 +378,13 @@ def shap_interp(args, model, tokenizer, prefix=""):
     return results
 
 
-def dump_shap_info(args, examples, features, tokenizer, predictions, prelim_results, attributions):
+def dump_shap_info(args, examples, features, tokenizer, predictions, prelim_results, attributions, shard_writer, io_pool):
     
     # attentions, attributions
     # N_Layer * B * N_HEAD * L * L
     attributions = attributions.detach().cpu().requires_grad_(False)
 
+    futures = []
     for example, feature, prelim_result, attribution in zip(
         examples,
         features,
@@ -229,30 +392,75 @@ def dump_shap_info(args, examples, features, tokenizer, predictions, prelim_resu
         torch.unbind(attributions)
     ):
         actual_len = len(feature.tokens)
-        attribution = attribution[:actual_len].clone().detach()
+        attribution = attribution[:actual_len].numpy()
+        max_abs = np.abs(attribution).max()
+        if max_abs > np.finfo(np.float16).max:
+            logger.warning("Attribution of example %d overflows float16", feature.example_index)
 
-        filename = os.path.join(args.interp_dir, f'{feature.example_index}-{feature.qas_id}.bin')
         prelim_result = prelim_result._asdict()
         prediction = predictions[example.qas_id]
-        torch.save({'example': example, 'feature': feature, 'prediction': prediction, 'prelim_result': prelim_result,
-            'attribution': attribution}, filename)
+        record = {'example': example, 'feature': feature, 'prediction': prediction, 'prelim_result': prelim_result}
+        futures.append(io_pool.submit(_write_shap_record, shard_writer, tokenizer, feature, record, attribution))
+    return futures
+
+def _pending_dumps(futures):
+    # raises the error of any finished dump, keeps the ones still running
+    pending = []
+    for future in futures:
+        if future.done():
+            future.result()
+        else:
+            pending.append(future)
+    return pending
+
+def _write_shap_record(shard_writer, tokenizer, feature, record, attribution):
+    # merge into words once here, tokens and full precision attribution are at hand
+    words, segments = merge_tokens_into_words(tokenizer, feature)
+    record['words'] = words
+    record['word_attribution'] = merge_token_attribution_by_segments(attribution, segments).astype(np.float32)
+    example = record['example']
+    summary = {'example_index': feature.example_index, 'qas_id': feature.qas_id,
+        'answer_text': example.answer_text, 'answers': example.answers, 'prediction': record['prediction'],
+        'prelim_result': record['prelim_result'], 'words': words, 'word_attribution': record['word_attribution'].tolist()}
+    shard_writer.write(feature.example_index, record, attribution, summary=summary)
+
+# args and tokenizer are sent once per worker instead of once per task
+def _init_vis_worker(args, tokenizer):
+    global _vis_args, _vis_tokenizer
+    _vis_args, _vis_tokenizer = args, tokenizer
+
+def _visualize_one(interp_info):
+    visualize_token_attributions(_vis_args, _vis_tokenizer, interp_info)
+
+def _visualize_file(filename):
+    _visualize_one(torch.load(filename))
 
 def ig_analyze(args, tokenizer):
-    filenames = os.listdir(args.interp_dir)
-    filenames.sort(key=lambda x: int(x.split('-')[0]))
-    # print(len(filenames))
-    datset_stats = []
     _mkdir_f(args.visual_dir)
-    for fname in tqdm(filenames, desc='Visualizing'):
-        interp_info = torch.load(os.path.join(args.interp_dir, fname))
-        # datset_stats.append(stats_of_ig_interpretation(tokenizer, interp_info))
-        visualize_token_attributions(args, tokenizer, interp_info)
+    if has_interp_shard(args.interp_dir):
+        vis_fn, tasks, total = _visualize_one, iter_interp_summaries(args.interp_dir), count_interp_summaries(args.interp_dir)
+    else:
+        # per example bin files from earlier runs, loaded in the workers
+        filenames = os.listdir(args.interp_dir)
+        filenames.sort(key=lambda x: int(x.split('-')[0]))
+        vis_fn, tasks, total = _visualize_file, [os.path.join(args.interp_dir, x) for x in filenames], len(filenames)
+    # each example is rendered independently
+    with Pool(os.cpu_count(), initializer=_init_vis_worker, initargs=(args, tokenizer)) as pool:
+        for _ in tqdm(pool.imap_unordered(vis_fn, tasks, chunksize=8), desc='Visualizing', total=total):
+            pass
 
 def main():
     parser = argparse.ArgumentParser()
     register_args(parser)
 
     parser.add_argument("--first_n_samples", default=4000, type=int, help="getting interpretation for first n sample")
+    parser.add_argument("--num_workers", default=2, type=int, help="Number of DataLoader workers loading examples ahead of SHAP.")
+    parser.add_argument("--shap_batch_size", default=32, type=int, help="Number of coalitions evaluated in one forward pass.")
+    parser.add_argument("--shap_cache_size", default=1024, type=int, help="Number of evaluated coalitions cached per example.")
+    parser.add_argument("--exact_shap_threshold", default=11, type=int, help="Enumerate every coalition instead of sampling when the number of tokens is at most this. Uses the same regression as sampling. Question plus context features rarely have this few tokens.")
+    parser.add_argument("--bf16", action="store_true", help="Run the inference forwards under bfloat16 autocast (requires torch>=1.10).")
+    parser.add_argument("--compile", action="store_true", help="Compile probe_forward with torch.compile (requires torch>=2.0).")
+    parser.add_argument("--resume", action="store_true", help="Skip examples already dumped to interp_dir by a previous run.")
     parser.add_argument("--do_vis", action="store_true", help="Whether to run vis on the dev set.")
     parser.add_argument("--interp_dir",default=None,type=str,required=True,help="The output directory where the model checkpoints and predictions will be written.")
     parser.add_argument("--visual_dir",default=None,type=str,help="The output visualization dir.")
@@ -268,6 +476,10 @@ def main():
         torch.distributed.init_process_group(backend="nccl")
         args.n_gpu = 1
     args.device = device
+    if args.bf16 and not hasattr(torch, 'autocast'):
+        raise RuntimeError('--bf16 requires torch>=1.10 for torch.autocast')
+    if args.compile and not hasattr(torch, 'compile'):
+        raise RuntimeError('--compile requires torch>=2.0 for torch.compile')
 
     # Setup logging
     logging.basicConfig(
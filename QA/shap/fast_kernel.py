@@ -0,0 +1,36 @@
+import numpy as np
+from numba import njit, prange
+
+# weighted least squares of kernel shap, X^T W X phi = X^T W y
+# masks are stored column major (one contiguous column per feature) for prange access
+# cached on disk, later processes skip compiling
+@njit(parallel=True, fastmath=True, cache=True)
+def _kshap_normal_equations(masks, values, weights):
+    num_samples, doc_size = masks.shape
+    gram = np.zeros((doc_size, doc_size))
+    rhs = np.zeros(doc_size)
+    for j in prange(doc_size):
+        col_j = masks[:, j]
+        acc = 0.0
+        for r in range(num_samples):
+            if col_j[r]:
+                acc += weights[r] * values[r]
+        rhs[j] = acc
+        # iteration j owns row j and column j from the diagonal on
+        for k in range(j, doc_size):
+            col_k = masks[:, k]
+            acc = 0.0
+            for r in range(num_samples):
+                if col_j[r] and col_k[r]:
+                    acc += weights[r]
+            gram[j, k] = acc
+            gram[k, j] = acc
+    return gram, rhs
+
+def kshap_weights(masks, values, weights):
+    masks = np.asfortranarray(masks, dtype=np.uint8)
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    weights = np.ascontiguousarray(weights, dtype=np.float64)
+    gram, rhs = _kshap_normal_equations(masks, values, weights)
+    # min-norm solution, same as the unregularized regression without intercept
+    return np.linalg.lstsq(gram, rhs, rcond=None)[0]
@@ -1,9 +1,9 @@
 import numpy as np
 import scipy as sp
 import sklearn
-from sklearn.linear_model import Ridge, LinearRegression
+from sklearn.linear_model import Ridge
 from scipy.special import binom
-from itertools import combinations
+from itertools import combinations, product
 
 ## modified from original lime implementation
 def lime_kernel(d, kernel_width=25):
@@ -81,8 +81,12 @@ def run_lime_attribution(args, doc_size, classifier_fn):
 
 ## modified from shap lime implementation
 
+def batched_classifier_labels(classifier_fn, data, batch_size):
+    # classifier_fn takes a stack of masks, buffer them up to batch_size per call
+    return np.concatenate([classifier_fn(data[i:i + batch_size]) for i in range(0, len(data), batch_size)])
+
 # hyper-paremeter inherited from oringinal shap implementation
-def shap_feat_label_weights(doc_size, classifier_fn, verbose=False):
+def shap_feat_label_weights(doc_size, classifier_fn, batch_size=32, verbose=False):
     # not working for small seq for now, needs more complex way
     num_sample = 2 * doc_size + 2 ** 11
     if num_sample > (2 ** doc_size - 2):
@@ -112,7 +116,7 @@ def shap_feat_label_weights(doc_size, classifier_fn, verbose=False):
         weight_of_size = (doc_size - 1) / (subset_size * (doc_size - subset_size)) / binom(doc_size, subset_size)
         # add all combination of this size
         for inds in combinations(features_idx, subset_size):
-            pos_mask = np.ones(doc_size, dtype=np.int64)
+            pos_mask = np.ones(doc_size, dtype=np.uint8)
             pos_mask[np.array(inds, dtype=np.int64)] = 0
             data.append(pos_mask)
             kernel_weights.append(weight_of_size)
@@ -141,7 +145,7 @@ def shap_feat_label_weights(doc_size, classifier_fn, verbose=False):
         
         for size in size_sample:
             selected = np.random.choice(features_idx, size, replace=False)
-            pos_mask = np.ones(doc_size, dtype=np.int64)
+            pos_mask = np.ones(doc_size, dtype=np.uint8)
             pos_mask[np.array(selected, dtype=np.int64)] = 0
             neg_mask = 1 - pos_mask
             data.append(pos_mask)
@@ -158,25 +162,41 @@ def shap_feat_label_weights(doc_size, classifier_fn, verbose=False):
                     sum([(doc_size - 1) / (s * (doc_size - s)) for s in remaining_possible_size]))
 
     data = np.stack(data)
-    labels = np.array([classifier_fn(d) for d in data])
+    labels = batched_classifier_labels(classifier_fn, data, batch_size)
     kernel_weights = np.array(kernel_weights)
     return data, labels, kernel_weights
 
 
 def shap_explain_instance_with_data(data, labels, weights):
-    model_regressor = LinearRegression(fit_intercept=False)    
-    model_regressor.fit(data, labels, sample_weight=weights)
-    return model_regressor.coef_    
+    # numba is only needed by shap, keep lime importable without it
+    from shap.fast_kernel import kshap_weights
+    return kshap_weights(data, labels, weights)
 
 def run_shap_attribution(args, doc_size, classifier_fn):
-    data, labels, weights = shap_feat_label_weights(doc_size, classifier_fn)
+    data, labels, weights = shap_feat_label_weights(doc_size, classifier_fn, batch_size=args.shap_batch_size)
     # print(data.shape, labels.shape, weights.shape)
     return shap_explain_instance_with_data(data, labels, weights)
 
+# enumerates all 2^L - 2 non-trivial coalitions, only for small doc size
+# same weighted regression without intercept as the sampled path, so short and long inputs share one basis
+def exact_shap_values(doc_size, classifier_fn, batch_size=32):
+    data = np.array(list(product([0, 1], repeat=doc_size)), dtype=np.uint8)
+    sizes = data.sum(axis=1)
+    # the empty and full coalitions get no kernel weight
+    data, sizes = data[(sizes > 0) & (sizes < doc_size)], sizes[(sizes > 0) & (sizes < doc_size)]
+    labels = batched_classifier_labels(classifier_fn, data, batch_size)
+    kernel_weights = (doc_size - 1) / (sizes * (doc_size - sizes)) / binom(doc_size, sizes)
+    return shap_explain_instance_with_data(data, labels, kernel_weights)
+
+def run_exact_shap_attribution(args, doc_size, classifier_fn):
+    return exact_shap_values(doc_size, classifier_fn, batch_size=args.shap_batch_size)
+
 if __name__=='__main__':
-    dummy_fn = lambda x: np.sum(x)
-    # run_shap_attribution(None, 4, dummy_fn)
-    # run_shap_attribution(None, 10, dummy_fn)
-    # run_shap_attribution(None, 20, dummy_fn)
-    val = run_shap_attribution(None, 100, dummy_fn)
+    from argparse import Namespace
+    dummy_fn = lambda x: np.sum(x, axis=1)
+    dummy_args = Namespace(shap_batch_size=32)
+    # run_shap_attribution(dummy_args, 4, dummy_fn)
+    # run_shap_attribution(dummy_args, 10, dummy_fn)
+    # run_shap_attribution(dummy_args, 20, dummy_fn)
+    val = run_shap_attribution(dummy_args, 100, dummy_fn)
     print(val)
\ No newline at end of file
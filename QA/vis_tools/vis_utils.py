@@ -34,14 +34,15 @@ def visualize_token_attributions(args, tokenizer, interp_info):
     prelim_result = interp_info['prelim_result']
     # attribution = attribution.res
 
-    attribution_val = attribution.numpy()
-    n_tokens = attribution_val.size
-
-    words, segments = merge_tokens_into_words(tokenizer, interp_info['feature'])
-    
-    # plot aggregated
-    # along layers
-    aggregated_attribution = merge_token_attribution_by_segments(attribution_val, segments)
+    # merged into words at dump time
+    if 'word_attribution' in interp_info:
+        words, aggregated_attribution = interp_info['words'], interp_info['word_attribution']
+    else:
+        attribution_val = attribution.numpy()
+        words, segments = merge_tokens_into_words(tokenizer, interp_info['feature'])
+        # plot aggregated
+        # along layers
+        aggregated_attribution = merge_token_attribution_by_segments(attribution_val, segments)
     visualize_vanilla_tok_attribution(prefix + '.jpg', words, aggregated_attribution, interp_info)
 
 def visualize_attributions(args, tokenizer, interp_info, do_head=False, do_layer=True):